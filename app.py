@@ -1,11 +1,21 @@
 import os
+import queue
+import random
+import re
 import asyncio
+import atexit
+import contextlib
+import hashlib
 import logging
-import json
+import threading
+from collections import OrderedDict
 from typing import Any
+import orjson
 import streamlit as st
+from azure.core.exceptions import HttpResponseError
 from azure.identity.aio import DefaultAzureCredential  
 from dotenv import load_dotenv
+from azure.ai.projects.models import ResponseFormatJsonSchema, ResponseFormatJsonSchemaType
 from semantic_kernel.agents.azure_ai.azure_ai_agent import AzureAIAgent
 
 # logging
@@ -14,6 +24,7 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 )
+log = logging.getLogger(__name__)
 
 # environment variables
 load_dotenv()
@@ -43,6 +54,77 @@ JSON_FORMAT = (
     '}'
 )
 
+# Same structure as JSON_FORMAT, set once on the claimhandler as structured output so it can be left out of the query
+CLAIM_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "policy_assessor": {
+            "type": "object",
+            "properties": {
+                "policy_number": {"type": "string"},
+                "claim_type": {"type": "string"},
+                "damage_claim": {"type": "string"}
+            },
+            "required": ["policy_number", "claim_type", "damage_claim"],
+            "additionalProperties": False
+        },
+        "fraud_detector": {
+            "type": "object",
+            "properties": {
+                "claim_description": {"type": "string"}
+            },
+            "required": ["claim_description"],
+            "additionalProperties": False
+        }
+    },
+    "required": ["policy_assessor", "fraud_detector"],
+    "additionalProperties": False
+}
+
+# Queries for the downstream agents, filled in with the claimhandler output
+POLICY_QUERY_TEMPLATE = (
+    "Based on the claim details: policy number {policy_number}, claim type {claim_type}, and damage claim amount {damage_claim} euros, "
+    "determine if the customer is appropriately covered under their policy."
+)
+FRAUD_QUERY_TEMPLATE = (
+    "Using the following claim description: {claim_description}, "
+    "evaluate whether there are any red flags or suspicious elements in the claim."
+)
+EVALUATOR_QUERY_TEMPLATE = (
+    "Policy Assessment: {policy_assessment}\n"
+    "Fraud Assessment: {fraud_assessment}\n"
+    "Based on the above assessments, should the claim be approved or rejected? Provide a concise explanation."
+)
+COMBINED_QUERY_TEMPLATE = "Policy task: {policy_query}\nFraud task: {fraud_query}"
+
+# Appended to the combined policy + fraud query, so both assessments come back in one response
+COMBINED_ASSESSMENT_FORMAT = (
+    "\nAnswer both tasks and provide a valid JSON response (no markdown formatting, just JSON) with the following structure:\n"
+    '{\n'
+    '  "policy_assessment": "value",\n'
+    '  "fraud_assessment": "value"\n'
+    '}'
+)
+
+# Sent to the claimhandler when its output cannot be parsed, retried with backoff
+# every call starts a new agent thread, so the claim and the previous output are included
+CLARIFICATION_QUERY_TEMPLATE = (
+    "Claim: {claim_query}\n"
+    "Your previous output for this claim: {output}\n"
+    "The output provided does not appear to be valid JSON. "
+    "Please provide a valid JSON response for this claim following the specified structure."
+)
+CLARIFICATION_ATTEMPTS = 3
+CLARIFICATION_TIMEOUT = 20  # seconds, doubled on every attempt
+
+# dashboard titles for the agent outputs
+POLICY_OUTPUT_TITLE = "Policy Agent Output"
+FRAUD_OUTPUT_TITLE = "Fraud Detection Agent Output"
+
+# used to recover JSON wrapped in markdown fences or surrounding prose
+JSON_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
 # define agents , sent query to claimhandler
 AGENTS_AND_QUERIES = {
     "ClaimHandlerAgent": {
@@ -59,126 +141,441 @@ AGENTS_AND_QUERIES = {
     }
 }
 
+# optional agent that handles policy and fraud assessment in a single call
+COMBINED_ASSESSOR_ID = os.environ.get("AZURE_AI_AGENT_COMBINED_ASSESSOR_ID")
+if COMBINED_ASSESSOR_ID:
+    AGENTS_AND_QUERIES["CombinedAssessorAgent"] = {"id": COMBINED_ASSESSOR_ID}
+
 if not (PROJECT_CONNECTION_STRING and MODEL_DEPLOYMENT_NAME and AGENTS_AND_QUERIES):
-    logging.error("Missing required configuration.")
+    log.error("Missing required configuration.")
     st.error("Missing required configuration.")
     st.stop()
 
-#invoke agents
-async def invoke_agent(agent: AzureAIAgent, query: str) -> str:
+# agent definitions are static, keep them across reruns instead of fetching them on every click
+@st.cache_resource
+def agent_definition_cache() -> dict[str, Any]:
+    return {}
+
+AGENT_DEFINITIONS = agent_definition_cache()
+
+#get agent definition from azure foundry (only on first use)
+async def get_agent_definition(client, agent_name: str):
+    agent_id = AGENTS_AND_QUERIES[agent_name]["id"]
+    definition = AGENT_DEFINITIONS.get(agent_id)
+    if definition is None:
+        fetched = await client.agents.get_agent(agent_id)
+        # keep a definition stored while fetching (e.g. the one returned by configure_claim_format)
+        definition = AGENT_DEFINITIONS.setdefault(agent_id, fetched)
+    return definition
+
+@st.cache_resource
+def claim_format_state() -> dict[str, Any]:
+    # the lock keeps warm-up and the first click from both updating the agent
+    return {"lock": asyncio.Lock()}
+
+CLAIM_FORMAT_STATE = claim_format_state()
+
+#set the claim JSON schema as structured output on the claimhandler (once per process)
+#returns False if the agent or model does not accept it, JSON_FORMAT is then sent with the query instead
+async def configure_claim_format(client) -> bool:
+    async with CLAIM_FORMAT_STATE["lock"]:
+        if "structured_output" not in CLAIM_FORMAT_STATE:
+            agent_id = AGENTS_AND_QUERIES["ClaimHandlerAgent"]["id"]
+            try:
+                definition = await client.agents.update_agent(
+                    assistant_id=agent_id,
+                    response_format=ResponseFormatJsonSchemaType(
+                        json_schema=ResponseFormatJsonSchema(name="structured_claim", schema=CLAIM_JSON_SCHEMA)
+                    )
+                )
+            except HttpResponseError as e:
+                if e.status_code != 400:
+                    raise
+                # rejected by the service, remembered for the rest of the process
+                log.warning("Structured output not available for ClaimHandlerAgent, using JSON_FORMAT: %s", e)
+                CLAIM_FORMAT_STATE["structured_output"] = False
+            else:
+                AGENT_DEFINITIONS[agent_id] = definition
+                CLAIM_FORMAT_STATE["structured_output"] = True
+        return CLAIM_FORMAT_STATE["structured_output"]
+
+#configure the claim format, other errors (network, auth) fall back to JSON_FORMAT for this run only and are retried on the next one
+async def claim_format_configured(client) -> bool:
+    try:
+        return await configure_claim_format(client)
+    except Exception as e:
+        log.warning("Could not configure structured output for ClaimHandlerAgent, retrying on the next run: %s", e)
+        return False
+
+#close the shared credential and client when the process exits
+def close_azure_client(state: dict[str, Any]) -> None:
+    stack = state.get("stack")
+    loop = state.get("loop")
+    if stack is None or loop is None or loop.is_closed():
+        return
     try:
-        #get_response from sk has built-in threading
-        response = await agent.get_response(messages=query)
-        if isinstance(response, tuple):
-            response = response[0]
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(stack.aclose(), loop).result(timeout=5)
+        else:
+            loop.run_until_complete(stack.aclose())
+    except Exception:
+        log.exception("Error closing Azure client.")
+
+# one event loop for the whole process, so the shared client and its connections survive between clicks
+@st.cache_resource
+def event_loop() -> tuple[asyncio.AbstractEventLoop, threading.Thread]:
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True)
+    thread.start()
+    return loop, thread
+
+#run a coroutine on the background loop and wait for the result
+#updates the coroutine puts on the queue are rendered here, st.* is only ever called from the script thread
+def run_async(coro, updates: queue.Queue | None = None, render=None):
+    loop, _ = event_loop()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        if updates is not None:
+            while not future.done():
+                try:
+                    render(*updates.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+            while not updates.empty():
+                render(*updates.get_nowait())
+        return future.result()
+    except BaseException:
+        # rerun/stop is raised from st.* calls, cancel the run instead of leaving it on the shared loop
+        future.cancel()
+        raise
+
+#send a dashboard update from the background loop to the script thread of the session that started the run
+def post_update(updates: queue.Queue | None, *update: Any) -> None:
+    if updates is not None:
+        updates.put(update)
+
+# credential and client are kept open for the lifetime of the process (token cache + connection pool)
+@st.cache_resource
+def azure_client_state() -> dict[str, Any]:
+    state: dict[str, Any] = {}
+    atexit.register(close_azure_client, state)
+    return state
+
+AZURE_CLIENT_STATE = azure_client_state()
+
+#get the shared client, created on first use
+async def get_client():
+    state = AZURE_CLIENT_STATE
+    loop = asyncio.get_running_loop()
+    if state.get("loop") is not loop:
+        # the client is bound to the event loop it was created on, close the old one before replacing it
+        old_stack = state.get("stack")
+        if old_stack is not None:
+            try:
+                await old_stack.aclose()
+            except Exception:
+                log.exception("Error closing Azure client.")
+        state.clear()
+        state["loop"] = loop
+        state["lock"] = asyncio.Lock()
+    async with state["lock"]:
+        if "client" not in state:
+            stack = contextlib.AsyncExitStack()
+            creds = await stack.enter_async_context(DefaultAzureCredential())
+            client = await stack.enter_async_context(
+                AzureAIAgent.create_client(credential=creds, conn_str=PROJECT_CONNECTION_STRING)
+            )
+            state.update(stack=stack, creds=creds, client=client)
+    return state["client"]
+
+# responses for identical queries are reused, oldest entries are dropped first
+RESPONSE_CACHE_SIZE = 128
+
+@st.cache_resource
+def response_cache() -> OrderedDict:
+    return OrderedDict()
+
+RESPONSE_CACHE = response_cache()
+
+def response_cache_key(agent: AzureAIAgent, query: str) -> tuple[str, str]:
+    return agent.definition.id, hashlib.sha1(query.encode()).hexdigest()
+
+def cache_response(cache_key: tuple[str, str], response: Any) -> None:
+    RESPONSE_CACHE[cache_key] = response
+    if len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+
+#text of an agent response, without the message envelope (role, metadata)
+def response_text(response: Any) -> str:
+    if isinstance(response, str):
         return response
+    message = getattr(response, "message", response)
+    content = getattr(message, "content", None)
+    return content if isinstance(content, str) else str(response)
+
+# token scope of the project client's agents pipeline (management.azure.com only covers connections/workspace)
+TOKEN_SCOPE = "https://ml.azure.com/.default"
+
+#create the shared client, fetch a token and configure the claimhandler, so the first click does not pay for it
+async def warm_up() -> None:
+    try:
+        client = await get_client()
+        await AZURE_CLIENT_STATE["creds"].get_token(TOKEN_SCOPE)
+        await claim_format_configured(client)
     except Exception as e:
-        logging.exception("Error invoking agent.")
-        return "Error invoking agent."
+        log.warning("Warm-up failed: %s", e)
+
+@st.cache_resource
+def start_warm_up():
+    loop, _ = event_loop()
+    return asyncio.run_coroutine_threadsafe(warm_up(), loop)
+
+start_warm_up()
+
+#invoke agents, errors are raised to the caller
+#use_cache=False skips the cache entirely, store=False only reads it (the caller caches the response once it is known to be usable)
+async def invoke_agent(agent: AzureAIAgent, query: str, use_cache: bool = True, store: bool = True) -> str:
+    cache_key = response_cache_key(agent, query)
+    cached_response = RESPONSE_CACHE.get(cache_key) if use_cache else None
+    if cached_response is not None:
+        RESPONSE_CACHE.move_to_end(cache_key)
+        return cached_response
+    #get_response from sk has built-in threading
+    response = await agent.get_response(messages=query)
+    if isinstance(response, tuple):
+        response = response[0]
+    response = response_text(response)
+    if use_cache and store:
+        cache_response(cache_key, response)
+    return response
+
+#invoke agent and yield the response text as it arrives
+async def invoke_agent_stream(agent: AzureAIAgent, query: str):
+    cache_key = response_cache_key(agent, query)
+    cached_response = RESPONSE_CACHE.get(cache_key)
+    if cached_response is not None:
+        RESPONSE_CACHE.move_to_end(cache_key)
+        yield cached_response
+        return
+    chunks = []
+    # errors are raised to the dashboard, a failed stream is never cached
+    async for chunk in agent.invoke_stream(messages=query):
+        text = response_text(chunk)
+        chunks.append(text)
+        yield text
+    cache_response(cache_key, "".join(chunks))
+
+#iterate an async generator on the background loop from the script thread (for st.write_stream)
+#the async generator is always closed on the loop, also when the consumer stops early (rerun, exception)
+def iterate_async(async_gen):
+    loop, _ = event_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(async_gen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(async_gen.aclose(), loop).result()
+
+#recover a JSON object from agent output locally, returns None if nothing usable is found
+def salvage_json(text: str) -> Any:
+    fence = JSON_FENCE_PATTERN.search(text)
+    if fence:
+        text = fence.group(1)
+    match = JSON_OBJECT_PATTERN.search(text)
+    if match is None:
+        return None
+    try:
+        return orjson.loads(match.group(0))
+    except orjson.JSONDecodeError:
+        return None
+
+#show an agent output in its dashboard slot
+def show_output(slot, title: str, output: Any) -> None:
+    if slot is None:
+        return
+    with slot.container():
+        st.subheader(title)
+        st.code(str(output))
+
+#render an update posted by the run on the script thread
+def render_update(slots: dict[str, Any], kind: str, *args: Any) -> None:
+    if kind == "message":
+        st.write(args[0])
+    elif kind == "output":
+        slot_name, title, output = args
+        show_output(slots[slot_name], title, output)
+
+#invoke agent and show the output as soon as it arrives
+async def invoke_agent_and_show(agent: AzureAIAgent, query: str, updates: queue.Queue | None, slot_name: str, title: str):
+    response = await invoke_agent(agent, query)
+    post_update(updates, "output", slot_name, title, response)
+    return response
+
+#parse agent output as a JSON object, falling back to local recovery; returns None if that fails too
+def parse_json(text: str) -> dict | None:
+    try:
+        parsed = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        parsed = salvage_json(text)
+    # a bare string, number or list is not a usable answer
+    return parsed if isinstance(parsed, dict) else None
+
+#ask the claimhandler again for valid JSON, bounded attempts with timeout and backoff
+async def request_clarification(claim_handler: AzureAIAgent, claim_query: str, output: str) -> Any:
+    for attempt in range(CLARIFICATION_ATTEMPTS):
+        log.warning(
+            "Failed to parse JSON output from ClaimHandlerAgent, attempting clarification (%d/%d): %r",
+            attempt + 1, CLARIFICATION_ATTEMPTS, output[:200]
+        )
+        clarification_query = CLARIFICATION_QUERY_TEMPLATE.format(claim_query=claim_query, output=output)
+        try:
+            # the answer depends on the previous output, so the cache is not used
+            output = await asyncio.wait_for(
+                invoke_agent(claim_handler, clarification_query, use_cache=False),
+                timeout=CLARIFICATION_TIMEOUT * 2 ** attempt
+            )
+        except asyncio.TimeoutError:
+            # the previous output is kept for the next attempt
+            log.warning("Clarification attempt timed out.")
+        except Exception:
+            log.exception("Error invoking agent.")
+        else:
+            parsed = parse_json(output)
+            if parsed is not None:
+                return parsed
+        if attempt < CLARIFICATION_ATTEMPTS - 1:
+            await asyncio.sleep(0.5 * 2 ** attempt + random.random() * 0.25)
+    log.warning("Clarification attempt failed, stop process: %r", output[:200])
+    return None
+
+#policy and fraud assessment, batched into one call when a combined agent is configured
+async def assess_claim(client, policy_query: str, fraud_query: str, updates: queue.Queue | None = None) -> tuple[Any, Any]:
+    if "CombinedAssessorAgent" in AGENTS_AND_QUERIES:
+        combined_def = await get_agent_definition(client, "CombinedAssessorAgent")
+        combined_agent = AzureAIAgent(client=client, definition=combined_def)
+        combined_query = (
+            COMBINED_QUERY_TEMPLATE.format(policy_query=policy_query, fraud_query=fraud_query)
+            + COMBINED_ASSESSMENT_FORMAT
+        )
+        post_update(updates, "message", "\nSending query to CombinedAssessorAgent...")
+        try:
+            # only cached once it can be split, so a broken answer is not replayed for the same claim
+            combined_str = await invoke_agent(combined_agent, combined_query, store=False)
+            combined = parse_json(combined_str)
+        except Exception:
+            log.exception("Error invoking agent.")
+            combined = None
+        if combined is not None and "policy_assessment" in combined and "fraud_assessment" in combined:
+            cache_response(response_cache_key(combined_agent, combined_query), combined_str)
+            post_update(updates, "output", "policy", POLICY_OUTPUT_TITLE, combined["policy_assessment"])
+            post_update(updates, "output", "fraud", FRAUD_OUTPUT_TITLE, combined["fraud_assessment"])
+            return combined["policy_assessment"], combined["fraud_assessment"]
+        log.warning("CombinedAssessorAgent output could not be split, falling back to separate agents.")
+
+    #get both agents from azure foundry, they only depend on parsed_claim so run them concurrently
+    #if one call raises, the task group cancels the other one, so no request is left running
+    async with asyncio.TaskGroup() as tg:
+        policy_def_task = tg.create_task(get_agent_definition(client, "PolicyAssessorAgent"))
+        fraud_def_task = tg.create_task(get_agent_definition(client, "FraudDetectionAgent"))
+    policy_agent = AzureAIAgent(client=client, definition=policy_def_task.result())
+    fraud_agent = AzureAIAgent(client=client, definition=fraud_def_task.result())
+    post_update(updates, "message", "\nSending query to PolicyAssessorAgent and FraudDetectionAgent...")
+    #sent queries
+    async with asyncio.TaskGroup() as tg:
+        policy_task = tg.create_task(invoke_agent_and_show(policy_agent, policy_query, updates, "policy", POLICY_OUTPUT_TITLE))
+        fraud_task = tg.create_task(invoke_agent_and_show(fraud_agent, fraud_query, updates, "fraud", FRAUD_OUTPUT_TITLE))
+    return policy_task.result(), fraud_task.result()
+
+#messages of an error, task group errors are flattened into the errors they contain
+def error_messages(error: BaseException) -> list[str]:
+    if isinstance(error, BaseExceptionGroup):
+        return [message for sub_error in error.exceptions for message in error_messages(sub_error)]
+    return [str(error)]
 
 #run agents 
-async def process_claim_run_agents(custom_claim_query: str):
+async def process_claim_run_agents(custom_claim_query: str, updates: queue.Queue | None = None):
     results = {}
     try:
-        # Append JSON formatting instructions to the final query to the agents.
-        full_claim_query = custom_claim_query + JSON_FORMAT
-
-        async with DefaultAzureCredential() as creds:
-            async with AzureAIAgent.create_client(credential=creds, conn_str=PROJECT_CONNECTION_STRING) as client:
-                
-                #   ClaimHandlerAgent
-
-                 #get agent from azure foundry
-                claim_handler_def = await client.agents.get_agent(AGENTS_AND_QUERIES["ClaimHandlerAgent"]["id"])
-                claim_handler = AzureAIAgent(client=client, definition=claim_handler_def)
-                claim_handler_query = full_claim_query
-          
-                structured_claim_json = await invoke_agent(claim_handler, claim_handler_query)
-                results["ClaimHandlerAgent Output"] = structured_claim_json
-            
-                
-                # convert response to string , parse as JSON.
-                try:
-                    structured_claim_str = str(structured_claim_json)
-                    parsed_claim = json.loads(structured_claim_str)
-                except json.JSONDecodeError:
-                    logging.exception("Failed to parse JSON output from ClaimHandlerAgent. Attempting clarification...")
-                    clarification_query = (
-                        "The output provided does not appear to be valid JSON."
-                        "Please provide a valid JSON response following the specified structure."
-                    )
-                    clarification_output = await invoke_agent(claim_handler, clarification_query)
-                    try:
-                        structured_claim_str = str(clarification_output)
-                        parsed_claim = json.loads(structured_claim_str)
-                    except json.JSONDecodeError:
-                        logging.exception("Clarification attempt failed, stop process.")
-                        results["error"] = "Clarification attempt failed, stop process."
-                        return results
-
-                results["Parsed Claim"] = parsed_claim
-
-                # Policy agent
-
-                #retrieve output from claimhandler
-                policy_number = parsed_claim.get('policy_assessor', {}).get('policy_number')
-                claim_type = parsed_claim.get('policy_assessor', {}).get('claim_type')
-                damage_claim = parsed_claim.get('policy_assessor', {}).get('damage_claim')
-                
-                policy_query = (
-                    f"Based on the claim details: policy number {policy_number}, claim type {claim_type}, and damage claim amount {damage_claim} euros, "
-                    "determine if the customer is appropriately covered under their policy."
-                )
-                #get agent from azure foundry
-                define_policy_agent = await client.agents.get_agent(AGENTS_AND_QUERIES["PolicyAssessorAgent"]["id"])
-                policy_agent = AzureAIAgent(client=client, definition=define_policy_agent)
-                st.write("\nSending query to PolicyAssessorAgent...")
-                #sent query
-                policy_assessment = await invoke_agent(policy_agent, policy_query)
-                results["PolicyAssessorAgent Output"] = policy_assessment
-            
-                
-                 #  FraudDetectionAgent 
-
-                 #retrieve output from claimhandler
-                claim_description = parsed_claim.get('fraud_detector', {}).get('claim_description')
-                
-                fraud_query = (
-                    f"Using the following claim description: {claim_description}, "
-                    "evaluate whether there are any red flags or suspicious elements in the claim."
-                )
+        client = await get_client()
+        #fetch all agent definitions at once, later lookups are served from the cache
+        async with asyncio.TaskGroup() as tg:
+            for agent_name in AGENTS_AND_QUERIES:
+                tg.create_task(get_agent_definition(client, agent_name))
 
-                #get agent from azure foundry
-                define_fraud_agent = await client.agents.get_agent(AGENTS_AND_QUERIES["FraudDetectionAgent"]["id"])
-                fraud_agent = AzureAIAgent(client=client, definition=define_fraud_agent)
-                st.write("\nSending query to FraudDetectionAgent...")
-                #sent query
-                fraud_assessment = await invoke_agent(fraud_agent, fraud_query)
-                results["FraudDetectionAgent Output"] = fraud_assessment
-               
-                
-                
-                #  ClaimEvaluatorAgent
-                
-                #include policy and fraud output in input of claim_evaluator_agent
-                evaluator_query = (
-                    f"Policy Assessment: {policy_assessment}\n"
-                    f"Fraud Assessment: {fraud_assessment}\n"
-                    "Based on the above assessments, should the claim be approved or rejected? Provide a concise explanation."
-                )
-                
-                #get agent from azure foundry
-                define_claim_evaluator_agent = await client.agents.get_agent(AGENTS_AND_QUERIES["ClaimEvaluatorAgent"]["id"])
-                claim_evaluator_agent = AzureAIAgent(client=client, definition=define_claim_evaluator_agent)
-                st.write("\nSending query to ClaimEvaluatorAgent:")
-                claim_evaluator_assesment = await invoke_agent(claim_evaluator_agent, evaluator_query)
-                results["ClaimEvaluatorAgent Output"] = claim_evaluator_assesment
-             
+        #   ClaimHandlerAgent
+
+        structured_output = await claim_format_configured(client)
+        #get agent from azure foundry
+        claim_handler_def = await get_agent_definition(client, "ClaimHandlerAgent")
+        claim_handler = AzureAIAgent(client=client, definition=claim_handler_def)
+        # JSON formatting instructions are only appended when the agent has no structured output
+        claim_handler_query = custom_claim_query if structured_output else custom_claim_query + JSON_FORMAT
+  
+        # only cached once it parses, so a broken answer is not replayed for the same claim
+        structured_claim_str = await invoke_agent(claim_handler, claim_handler_query, store=False)
+        results["ClaimHandlerAgent Output"] = structured_claim_str
+    
+        
+        # parse response text as JSON, recover it locally before asking the agent again
+        parsed_claim = parse_json(structured_claim_str)
+        if parsed_claim is not None:
+            cache_response(response_cache_key(claim_handler, claim_handler_query), structured_claim_str)
+        else:
+            parsed_claim = await request_clarification(claim_handler, claim_handler_query, structured_claim_str)
+            if parsed_claim is None:
+                results["error"] = "Clarification attempt failed, stop process."
+                return results
+
+        results["Parsed Claim"] = parsed_claim
+
+        #retrieve output from claimhandler
+        policy_details = parsed_claim.get('policy_assessor') or {}
+        fraud_details = parsed_claim.get('fraud_detector') or {}
+        policy_number = policy_details.get('policy_number')
+        claim_type = policy_details.get('claim_type')
+        damage_claim = policy_details.get('damage_claim')
+        claim_description = fraud_details.get('claim_description')
+
+        # Policy agent
+        policy_query = POLICY_QUERY_TEMPLATE.format(
+            policy_number=policy_number, claim_type=claim_type, damage_claim=damage_claim
+        )
+
+        #  FraudDetectionAgent 
+        fraud_query = FRAUD_QUERY_TEMPLATE.format(claim_description=claim_description)
+
+        policy_assessment, fraud_assessment = await assess_claim(client, policy_query, fraud_query, updates)
+        results["PolicyAssessorAgent Output"] = policy_assessment
+        results["FraudDetectionAgent Output"] = fraud_assessment
+        
+        
+        #  ClaimEvaluatorAgent
+        
+        #include policy and fraud output in input of claim_evaluator_agent
+        evaluator_query = EVALUATOR_QUERY_TEMPLATE.format(
+            policy_assessment=policy_assessment, fraud_assessment=fraud_assessment
+        )
+        
+        # evaluator response is streamed to the dashboard, see stream_claim_evaluation
+        results["ClaimEvaluatorAgent Query"] = evaluator_query
+     
     except Exception as e:
-        logging.exception("An unexpected error occurred .")
-        results["error"] = str(e)
+        log.exception("An unexpected error occurred .")
+        # report the underlying errors rather than the task group wrapper
+        results["error"] = "; ".join(error_messages(e))
     return results
 
+#  ClaimEvaluatorAgent, streamed so the answer shows up while it is generated
+async def stream_claim_evaluation(evaluator_query: str):
+    client = await get_client()
+    #get agent from azure foundry
+    define_claim_evaluator_agent = await get_agent_definition(client, "ClaimEvaluatorAgent")
+    claim_evaluator_agent = AzureAIAgent(client=client, definition=define_claim_evaluator_agent)
+    async for text in invoke_agent_stream(claim_evaluator_agent, evaluator_query):
+        yield text
+
 #-- Streamlit dashboard interface
 st.title("Insurance claim dashboard")
 st.write("Enter your claim query below and click the button to process the claim using Azure AI Agents.")
@@ -187,26 +584,50 @@ st.write("Enter your claim query below and click the button to process the claim
 user_claim_query = st.text_area("Query:", value=CLAIM_QUERY, height=150)
 
 if st.button("Process Claim"):
+    # slots are filled in as soon as each agent finishes
+    summary_slot = st.empty()
+    policy_slot = st.empty()
+    fraud_slot = st.empty()
+    evaluation_slot = st.empty()
+    summary_slot.header("Summary", divider="gray")
+    # progress and agent outputs of this run only, rendered by run_async on this session's script thread
+    updates = queue.Queue()
+    slots = {"policy": policy_slot, "fraud": fraud_slot}
     # streamlit spinner 
     with st.spinner("Processing the claim..."):
-        results = asyncio.run(process_claim_run_agents(user_claim_query))
+        results = run_async(
+            process_claim_run_agents(user_claim_query, updates),
+            updates,
+            lambda *update: render_update(slots, *update)
+        )
     if "error" in results:
+        # partial output of a failed run is removed together with the summary header
+        summary_slot.empty()
+        policy_slot.empty()
+        fraud_slot.empty()
         st.error("An error occurred: " + results["error"])
     else:
-        st.success("Processing complete!")
-        st.header("Summary", divider="gray")
-        st.subheader("Policy Agent Output")
-        st.code(results.get("PolicyAssessorAgent Output", "No output"))
-        st.subheader("Fraud Detection Agent Output")
-        st.code(results.get("FraudDetectionAgent Output", "No output"))
-        st.subheader("Claim Evaluation")
-        st.code(results.get("ClaimEvaluatorAgent Output", "No output"))
+        evaluation_stream = iterate_async(stream_claim_evaluation(results["ClaimEvaluatorAgent Query"]))
+        try:
+            with evaluation_slot.container():
+                st.subheader("Claim Evaluation")
+                results["ClaimEvaluatorAgent Output"] = st.write_stream(evaluation_stream)
+        except Exception as e:
+            log.exception("An unexpected error occurred .")
+            results["error"] = str(e)
+        finally:
+            evaluation_stream.close()
+        if "error" in results:
+            evaluation_slot.empty()
+            st.error("An error occurred: " + results["error"])
+        else:
+            st.success("Processing complete!")
         
         # download button
         parsed_claim = results.get("Parsed Claim", {})
         st.download_button(
             label="Download Claim (JSON)",
-            data=json.dumps(parsed_claim, indent=2),
+            data=orjson.dumps(parsed_claim, option=orjson.OPT_INDENT_2),
             file_name="parsed_claim.json",
             mime="application/json"
         )